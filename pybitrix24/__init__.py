@@ -1,4 +1,9 @@
 from .bitrix24 import Bitrix24, get_error_if_present
 from .exceptions import *
+from .duplicates import find_duplicates, normalize_comm, DuplicateCache
+from .export import export_list, iter_pages, ExportStats
+from .schema import SchemaCache
+from .streams import Base64JsonBody
+from .transport import Transport, UrllibTransport, RecordReplayTransport
 
 __version__ = '1.1.0'
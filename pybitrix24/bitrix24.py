@@ -1,5 +1,11 @@
+import os
+
 from .exceptions import PBx24AttributeError, PBx24ArgumentError
-from .requester import encode_url, request, prepare_batch_command
+from .requester import encode_url, prepare_batch_command, \
+    iter_batch_requests, split_call, BATCH_MAX_COMMANDS, BATCH_MAX_BYTES
+from .schema import is_metadata_method, validate_params
+from .streams import Base64JsonBody
+from .transport import UrllibTransport
 
 
 def get_error_if_present(data):
@@ -33,6 +39,29 @@ class ConditionalDict(dict):
             dict.__setitem__(self, key, value)
 
 
+def _merge_batch_result(merged, result):
+    for key, value in result.items():
+        # Empty results are encoded as lists by the server
+        if isinstance(value, dict):
+            merged.setdefault(key, {}).update(value)
+        else:
+            merged.setdefault(key, {})
+
+
+def _merge_call_result(merged, name, data):
+    error = data.get('error')
+    if error is not None:
+        merged['result_error'][name] = {
+            'error': error,
+            'error_description': data.get('error_description')
+        }
+        return
+    merged['result'][name] = data.get('result')
+    for key in ('total', 'next', 'time'):
+        if key in data:
+            merged['result_' + key][name] = data[key]
+
+
 class Bitrix24(object):
     """
     The main caller of Bitrix24 REST API. The caller has several methods
@@ -49,7 +78,8 @@ class Bitrix24(object):
     _call_url_template = '{url}{method}.json'
 
     def __init__(self, hostname, client_id=None, client_secret=None,
-                 user_id=1, auth_hostname=None):
+                 user_id=1, auth_hostname=None, transport=None,
+                 schema_cache=None):
         """
         Initialize object attributes. Note that the application ID and key
         arguments are not required if webhooks will be called only.
@@ -61,6 +91,9 @@ class Bitrix24(object):
         :param client_secret: str Application key
         :param user_id: int A numeric ID of the user (used by webhooks)
         :param auth_hostname: string A hostname of an auth server for box versions of Bitrix24
+        :param transport: Transport An I/O layer for sending requests
+            (:class:`UrllibTransport` by default)
+        :param schema_cache: SchemaCache A cache of metadata responses
         """
         if hostname is None:
             raise PBx24ArgumentError("The 'hostname' argument is required")
@@ -69,6 +102,9 @@ class Bitrix24(object):
         self.client_secret = client_secret
         self.user_id = user_id
         self.auth_hostname = auth_hostname
+        self.transport = transport if transport is not None \
+            else UrllibTransport()
+        self.schema_cache = schema_cache
         self._access_token = None
         self._refresh_token = None
 
@@ -142,7 +178,7 @@ class Bitrix24(object):
 
     def _request_tokens(self, query):
         url = self._build_oauth_url('token')
-        data = request(url, query=query)
+        data = self.transport.request(url, query=query)
         self._access_token = data.get('access_token')
         self._refresh_token = data.get('refresh_token')
         return data
@@ -198,7 +234,7 @@ class Bitrix24(object):
 
     def _call(self, url, method, query, params):
         url = self._call_url_template.format(url=url, method=method)
-        data = request(url, query, params)
+        data = self.transport.request(url, query, params)
         return data
 
     def call_batch(self, calls, halt_on_error=False):
@@ -220,6 +256,66 @@ class Bitrix24(object):
         })
         return data
 
+    def call_batches(self, calls, halt_on_error=False,
+                     max_commands=BATCH_MAX_COMMANDS,
+                     max_bytes=BATCH_MAX_BYTES):
+        """
+        Group any number of calls into as few batch requests as possible.
+        Batches are filled by both count of commands and size of a request
+        body, a call which alone exceeds the size limit is sent as a regular
+        request instead (in its original position). Responses are merged into
+        a single batch response. Note that calls may be split into different
+        batches, so macros referencing results of other calls aren't
+        supported.
+
+        If a whole batch request fails (e.g. with QUERY_LIMIT_EXCEEDED), no
+        more requests are sent: the error is added to the response and to
+        ``result_error`` for each call of the failed batch, results of
+        previous requests are kept. Calls that weren't sent are missing in
+        both ``result`` and ``result_error``.
+
+        :param calls: dict Call params by names
+        :param halt_on_error: bool Stop sending requests after an error
+        :param max_commands: int Maximum number of commands per batch
+        :param max_bytes: int Maximum size of a batch request body
+        :return: dict Merged response data
+        """
+        return self._call_batches(self.call, calls, halt_on_error,
+                                  max_commands, max_bytes)
+
+    def _call_batches(self, call, calls, halt_on_error, max_commands,
+                      max_bytes):
+        merged = dict((key, {}) for key in ('result', 'result_error',
+                                            'result_total', 'result_next',
+                                            'result_time'))
+        error = None
+        for request_ in iter_batch_requests(calls, max_commands, max_bytes):
+            if isinstance(request_, dict):
+                data = call('batch', {'cmd': request_, 'halt': halt_on_error})
+                error = data.get('error')
+                if error is not None:
+                    # Results of previous requests are kept to avoid
+                    # repeating them (e.g. creating entities twice)
+                    for name in request_:
+                        _merge_call_result(merged, name, data)
+                    break
+                _merge_batch_result(merged, data.get('result') or {})
+            else:
+                name, call_ = request_
+                method, params = split_call(name, call_)
+                _merge_call_result(merged, name, call(method, params))
+            if halt_on_error and merged['result_error']:
+                break
+
+        # Mimic the server that encodes empty results as lists
+        for key, value in merged.items():
+            if not value:
+                merged[key] = []
+        data = {'result': merged}
+        if error is not None:
+            data['error'] = error
+        return data
+
     def call_event_bind(self, event, handler, auth_type=None, event_type=None):
         """
         Install a new event handler.
@@ -310,3 +406,122 @@ class Bitrix24(object):
             'halt': halt_on_error
         })
         return data
+
+    def call_batches_webhook(self, code, calls, halt_on_error=False,
+                             max_commands=BATCH_MAX_COMMANDS,
+                             max_bytes=BATCH_MAX_BYTES):
+        """
+        Group any number of calls into as few batch requests as possible.
+        This method mimics :meth:`call_batches` except adding an access token
+        to the request.
+
+        :param code: str WebHook code
+        :param calls: dict Call params by names
+        :param halt_on_error: bool Stop sending requests after an error
+        :param max_commands: int Maximum number of commands per batch
+        :param max_bytes: int Maximum size of a batch request body
+        :return: dict Merged response data
+        """
+        def call(method, params):
+            return self.call_webhook(code, method, params)
+
+        return self._call_batches(call, calls, halt_on_error, max_commands,
+                                  max_bytes)
+
+    def call_schema(self, method, params=None, code=None):
+        """
+        Request metadata (methods, scope, app.info or *.fields) through
+        :attr:`schema_cache`, so it's requested only once per cache TTL
+        across process restarts. Error responses aren't cached.
+
+        :raise PBx24ArgumentError: If a method doesn't return metadata
+        :param method: str Method name (words separated by dots)
+        :param params: dict Request parameters
+        :param code: str WebHook code (an access token is used if not set)
+        :return: dict Response data
+        """
+        if not is_metadata_method(method):
+            raise PBx24ArgumentError(
+                'The "' + method + '" method does not return metadata')
+        if self.schema_cache is not None:
+            data = self.schema_cache.get(self.hostname, method, params)
+            if data is not None:
+                return data
+        if code is None:
+            data = self.call(method, params)
+        else:
+            data = self.call_webhook(code, method, params)
+        if self.schema_cache is not None and data.get('error') is None:
+            self.schema_cache.set(self.hostname, method, params, data)
+        return data
+
+    def validate_params(self, method, params, code=None):
+        """
+        Check params of crm.*.add, crm.*.update and crm.*.list methods
+        against a cached field schema before calling them. Params of other
+        methods aren't checked.
+
+        :raise PBx24ArgumentError: If params contain unknown or read-only
+            fields or miss required ones
+        :param method: str Method name (words separated by dots)
+        :param params: dict Request parameters
+        :param code: str WebHook code (an access token is used if not set)
+        """
+        validate_params(method, params,
+                        lambda fields_method: self.call_schema(
+                            fields_method, code=code))
+
+    def call_upload(self, method, params, fileobj, path=('fileContent',),
+                    filename=None, code=None):
+        """
+        Upload a file by streaming its base64-encoded content within a JSON
+        request body, so memory usage doesn't depend on the file size.
+
+        Usage::
+
+            with open('report.pdf', 'rb') as f:
+                bx24.call_upload('disk.folder.uploadfile',
+                                 {'id': 1, 'data': {'NAME': 'report.pdf'}}, f)
+
+        See more:
+        * `How to Upload Files
+            <https://training.bitrix24.com/rest_help/js_library/rest/files.php>`_
+
+        :param method: str Method name (words separated by dots)
+        :param params: dict Request parameters
+        :param fileobj: file A binary file object
+        :param path: tuple Keys of params to put a pair of the file name and
+            content to (e.g. ``('fields', 'UF_CRM_FILE', 'fileData')``)
+        :param filename: str A file name (a name of the file object is used
+            if not set)
+        :param code: str WebHook code (an access token is used if not set)
+        :return: dict Response data
+        """
+        if filename is None:
+            filename = os.path.basename(getattr(fileobj, 'name', '') or '')
+        if not filename:
+            raise PBx24ArgumentError("The 'filename' argument is required")
+        if code is None:
+            url = self._method_url_template.format(hostname=self.hostname)
+            query = {'auth': self._access_token}
+        else:
+            url = self._webhook_url_template.format(hostname=self.hostname,
+                                                    user_id=self.user_id,
+                                                    code=code)
+            query = None
+        url = self._call_url_template.format(url=url, method=method)
+        body = Base64JsonBody(params, path, fileobj, filename)
+        data = self.transport.request_stream(url, query, body)
+        return data
+
+    def download_file(self, url, fileobj):
+        """
+        Download a file (e.g. by DOWNLOAD_URL returned by disk.file.get) to
+        a binary file object chunk by chunk.
+
+        :param url: str An absolute download URL
+        :param fileobj: file A binary file object
+        :return: int A number of written bytes
+        """
+        size = self.transport.download(url, fileobj)
+        return size
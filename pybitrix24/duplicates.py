@@ -0,0 +1,214 @@
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from .exceptions import PBx24ArgumentError, PBx24RequestError
+from .requester import pack_batch_commands, prepare_command, \
+    BATCH_MAX_COMMANDS
+
+COMM_TYPE_EMAIL = 'EMAIL'
+COMM_TYPE_PHONE = 'PHONE'
+
+# Maximum number of values per crm.duplicate.findbycomm call
+FINDBYCOMM_MAX_VALUES = 20
+
+_NON_PHONE_CHARS_RE = re.compile(r'[^\d]')
+
+
+def normalize_comm(comm_type, value):
+    """Return a normalized communication value or None if it's empty.
+
+    >>> normalize_comm('EMAIL', ' John.Doe@Example.com ')
+    'john.doe@example.com'
+    >>> normalize_comm('PHONE', '+1 (555) 010-99-88')
+    '+15550109988'
+    >>> normalize_comm('PHONE', 15550109988)
+    '15550109988'
+    >>> normalize_comm('PHONE', 'n/a') is None
+    True
+    """
+    # Phone numbers often come as numbers from spreadsheets
+    value = u'%s' % value if value is not None else u''
+    value = value.strip()
+    if comm_type == COMM_TYPE_EMAIL:
+        value = value.lower()
+    elif comm_type == COMM_TYPE_PHONE:
+        prefix = '+' if value.startswith('+') else ''
+        digits = _NON_PHONE_CHARS_RE.sub('', value)
+        value = prefix + digits if digits else ''
+    else:
+        raise PBx24ArgumentError(
+            "The 'comm_type' argument must be 'EMAIL' or 'PHONE'")
+    return value or None
+
+
+def _copy_result(result):
+    return dict((entity_type, list(ids)) for entity_type, ids
+                in (result or {}).items())
+
+
+class DuplicateCache(object):
+    """
+    A short-lived in-memory cache of duplicate lookups, so values repeated
+    across an import are looked up only once. Expired entries are pruned on
+    each insert and the oldest ones are evicted when the cache is full. It's
+    safe to share between threads.
+    """
+
+    def __init__(self, ttl=5 * 60, max_size=100000):
+        """
+        :param ttl: int Lifetime of cache entries in seconds
+        :param max_size: int Maximum number of cache entries
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Entries are ordered by time of storing, the oldest go first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            return _copy_result(value)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now, _copy_result(value))
+            while self._entries:
+                oldest_key = next(iter(self._entries))
+                stored_at, _ = self._entries[oldest_key]
+                if now - stored_at <= self.ttl and \
+                        len(self._entries) <= self.max_size:
+                    break
+                del self._entries[oldest_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _run_batches(call, calls, workers):
+    """Send calls packed into batches concurrently and return results."""
+    batches, oversize = pack_batch_commands(calls, BATCH_MAX_COMMANDS)
+    batches.extend({name: prepare_command(name, call_)}
+                   for name, call_ in oversize.items())
+
+    def run(commands):
+        data = call('batch', {'cmd': commands, 'halt': False})
+        if data.get('error') is not None:
+            raise PBx24RequestError(
+                'Error on requesting duplicates', data.get('error'),
+                data.get('error_description'))
+        result = data.get('result') or {}
+        if result.get('result_error'):
+            raise PBx24RequestError(
+                'Error on requesting duplicates', result['result_error'])
+        return result.get('result') or {}
+
+    results = {}
+    if workers > 1 and len(batches) > 1:
+        pool = ThreadPool(min(workers, len(batches)))
+        try:
+            for result in pool.map(run, batches):
+                results.update(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for commands in batches:
+            results.update(run(commands))
+    return results
+
+
+def _findbycomm_call(comm_type, values, entity_type):
+    params = {'type': comm_type, 'values': values}
+    if entity_type is not None:
+        params['entity_type'] = entity_type
+    return 'crm.duplicate.findbycomm', params
+
+
+def find_duplicates(call, comm_type, values, entity_type=None, cache=None,
+                    workers=4):
+    """
+    Look up CRM entities by many phone numbers or emails at once. Values are
+    normalized and deduplicated first, then looked up in groups of up to
+    20 values per crm.duplicate.findbycomm call packed into batches that run
+    concurrently. Since a group call doesn't tell which value matched, only
+    groups with matches are looked up again value by value (most values are
+    usually new during an import).
+
+    Usage::
+
+        cache = DuplicateCache()
+        find_duplicates(bx24.call, 'PHONE', ['+1 555 010-99-88', ...],
+                        entity_type='CONTACT', cache=cache)
+        # {'+1 555 010-99-88': {'CONTACT': [12, 34]}, ...}
+
+    See more:
+    * `crm.duplicate.findbycomm
+        <https://training.bitrix24.com/rest_help/crm/auxiliary/duplicates/crm.duplicate.findbycomm.php>`_
+
+    :raise PBx24ArgumentError: If the communication type is not supported
+    :raise PBx24RequestError: If a response contains an error
+    :param call: callable A caller like :meth:`Bitrix24.call` (use
+        ``functools.partial(bx24.call_webhook, code)`` for webhooks)
+    :param comm_type: str 'EMAIL' or 'PHONE'
+    :param values: list Values to look up
+    :param entity_type: str 'LEAD', 'CONTACT' or 'COMPANY' (all by default)
+    :param cache: DuplicateCache A cache of previous lookups
+    :param workers: int Maximum number of concurrent batch requests
+    :return: dict Entity IDs by entity types for each of the given values
+    """
+    normalized = dict((value, normalize_comm(comm_type, value))
+                      for value in values)
+    found = {}
+    pending = []
+    for value in sorted(set(v for v in normalized.values() if v)):
+        key = (comm_type, entity_type, value)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            found[value] = cached
+        else:
+            pending.append(value)
+
+    groups = [pending[i:i + FINDBYCOMM_MAX_VALUES]
+              for i in range(0, len(pending), FINDBYCOMM_MAX_VALUES)]
+    results = _run_batches(call, dict(
+        ('g%d' % i, _findbycomm_call(comm_type, group, entity_type))
+        for i, group in enumerate(groups)), workers)
+    ambiguous = []
+    for i, group in enumerate(groups):
+        result = results.get('g%d' % i) or {}
+        if not result or len(group) == 1:
+            for value in group:
+                found[value] = result
+        else:
+            ambiguous.extend(group)
+
+    results = _run_batches(call, dict(
+        ('v%d' % i, _findbycomm_call(comm_type, [value], entity_type))
+        for i, value in enumerate(ambiguous)), workers)
+    for i, value in enumerate(ambiguous):
+        found[value] = results.get('v%d' % i) or {}
+
+    if cache is not None:
+        for value in pending:
+            cache.set((comm_type, entity_type, value), found[value])
+    # Each value gets its own copy, so mutating one doesn't affect others
+    return dict((value, _copy_result(found.get(norm)))
+                for value, norm in normalized.items())
@@ -0,0 +1,290 @@
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+from .exceptions import PBx24ArgumentError, PBx24RequestError
+from .utils import dump_json_atomically, load_json, to_bytes
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+
+_FORMATS = (FORMAT_NDJSON, FORMAT_CSV)
+
+
+def iter_pages(call, method, params=None, start=0):
+    """
+    Iterate over pages of a list method (e.g. crm.deal.list) using the
+    ``start``/``next`` pagination of Bitrix24 REST API. Only one page is held
+    in memory at a time.
+
+    :raise PBx24RequestError: If a response contains an error
+    :param call: callable A caller like :meth:`Bitrix24.call`
+    :param method: str Method name (words separated by dots)
+    :param params: dict Request parameters
+    :param start: int An offset of the first page
+    :return: generator of tuples (start, rows, next_start) where next_start
+        is None for the last page
+    """
+    while start is not None:
+        page_params = dict(params or {})
+        page_params['start'] = start
+        data = call(method, page_params)
+        error = data.get('error')
+        if error is not None:
+            raise PBx24RequestError(
+                'Error on requesting "%s" page' % method, error,
+                data.get('error_description'))
+        rows = _extract_rows(data.get('result'))
+        next_start = data.get('next')
+        yield start, rows, next_start
+        start = next_start
+
+
+def _extract_rows(result):
+    if isinstance(result, list):
+        return result
+    # Some methods (e.g. tasks.task.list) wrap a list into a dictionary
+    if isinstance(result, dict):
+        lists = [v for v in result.values() if isinstance(v, list)]
+        if len(lists) == 1:
+            return lists[0]
+    raise PBx24ArgumentError("Data is not a valid list response")
+
+
+class ExportStats(object):
+    """Progress of an export reported after each page."""
+
+    def __init__(self, rows=0, pages=0):
+        self.rows = rows
+        self.pages = pages
+        self.started_at = time.time()
+        self._initial_rows = rows
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return (self.rows - self._initial_rows) / elapsed
+
+
+class _Output(object):
+    """
+    A binary output file optionally compressed with gzip. Each checkpoint
+    closes the current gzip member, so the file truncated to a checkpointed
+    offset is always a valid (multi-member) gzip stream.
+    """
+
+    def __init__(self, path, compress, offset=None):
+        if offset is None:
+            self._raw = io.open(path, 'wb')
+        else:
+            self._raw = io.open(path, 'r+b')
+            self._raw.truncate(offset)
+            self._raw.seek(offset)
+        self._compress = compress
+        self._stream = self._open_stream()
+
+    def _open_stream(self):
+        if self._compress:
+            return gzip.GzipFile(fileobj=self._raw, mode='wb')
+        return self._raw
+
+    def write(self, data):
+        self._stream.write(data)
+
+    def checkpoint(self):
+        if self._compress:
+            self._stream.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        offset = self._raw.tell()
+        # A new gzip member writes its header immediately
+        if self._compress:
+            self._stream = self._open_stream()
+        return offset
+
+    def close(self):
+        if self._compress:
+            self._stream.close()
+        self._raw.close()
+
+
+class _NdjsonEncoder(object):
+    def __init__(self, columns=None):
+        self.columns = columns
+
+    def header(self):
+        return b''
+
+    def encode(self, rows):
+        lines = []
+        for row in rows:
+            if self.columns is not None:
+                row = dict((c, row.get(c)) for c in self.columns)
+            lines.append(to_bytes(json.dumps(row, ensure_ascii=False,
+                                              separators=(',', ':'))))
+            lines.append(b'\n')
+        return b''.join(lines)
+
+
+class _CsvEncoder(object):
+    def __init__(self, columns=None):
+        self.columns = columns
+
+    def _format(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        return value
+
+    def _write(self, lines):
+        if sys.version_info.major == 2:
+            buf = io.BytesIO()
+            lines = [[v.encode('utf-8') if isinstance(v, type(u'')) else v
+                      for v in line] for line in lines]
+        else:
+            buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerows(lines)
+        return to_bytes(buf.getvalue())
+
+    def header(self):
+        return self._write([self.columns])
+
+    def encode(self, rows):
+        return self._write([[self._format(row.get(c)) for c in self.columns]
+                            for row in rows])
+
+
+_ENCODERS = {
+    FORMAT_NDJSON: _NdjsonEncoder,
+    FORMAT_CSV: _CsvEncoder,
+}
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return load_json(path)
+
+
+def export_list(call, method, path, params=None, format=FORMAT_NDJSON,
+                compress=False, columns=None, checkpoint_path=None,
+                checkpoint_every=20, on_progress=None):
+    """
+    Stream all rows of a list method to an NDJSON or CSV file page by page,
+    so memory usage doesn't depend on the number of exported rows.
+
+    If a checkpoint path is set, the export state is saved there every
+    ``checkpoint_every`` pages and when the export fails. Running the same
+    export again resumes it from the last saved page (the output file is
+    truncated to the checkpointed size first). The checkpoint is removed
+    when the export completes.
+
+    Usage::
+
+        export_list(bx24.call, 'crm.deal.list', 'deals.ndjson.gz',
+                    params={'select': ['ID', 'TITLE']}, compress=True,
+                    checkpoint_path='deals.checkpoint')
+
+    :raise PBx24ArgumentError: If the format is not supported or a checkpoint
+        doesn't match the export
+    :raise PBx24RequestError: If a response contains an error
+    :param call: callable A caller like :meth:`Bitrix24.call` (use
+        ``functools.partial(bx24.call_webhook, code)`` for webhooks)
+    :param method: str List method name (e.g. crm.deal.list)
+    :param path: str A path of the output file
+    :param params: dict Request parameters
+    :param format: str 'ndjson' or 'csv'
+    :param compress: bool Compress the output file with gzip
+    :param columns: list Columns to export (by default keys of the first row
+        are used for CSV and all keys for NDJSON)
+    :param checkpoint_path: str A path of the resume checkpoint file
+    :param checkpoint_every: int Save a checkpoint every N pages
+    :param on_progress: callable Called with :class:`ExportStats` after
+        each page
+    :return: ExportStats Final export stats
+    """
+    if format not in _FORMATS:
+        raise PBx24ArgumentError(
+            "The 'format' argument must be one of: " + ', '.join(_FORMATS))
+    if checkpoint_every < 1:
+        raise PBx24ArgumentError(
+            "The 'checkpoint_every' argument must be positive")
+
+    # Round trip through JSON to compare with a loaded checkpoint
+    identity = json.loads(json.dumps({
+        'method': method,
+        'params': params or {},
+        'format': format,
+        'compress': bool(compress),
+    }))
+    state = _load_checkpoint(checkpoint_path)
+    if state is not None:
+        if any(state.get(k) != v for k, v in identity.items()):
+            raise PBx24ArgumentError(
+                "The checkpoint doesn't match the export: " + checkpoint_path)
+        start, offset, columns = state['start'], state['offset'], \
+            state['columns']
+        stats = ExportStats(rows=state['rows'], pages=state['pages'])
+    else:
+        start, offset = 0, None
+        stats = ExportStats()
+    if columns is not None:
+        columns = list(columns)
+
+    output = _Output(path, compress, offset=offset)
+    encoder = None
+
+    def checkpoint(next_start):
+        state = dict(identity, start=next_start, offset=output.checkpoint(),
+                     columns=columns, rows=stats.rows, pages=stats.pages)
+        dump_json_atomically(checkpoint_path, state)
+
+    # Pages are fully written or not written at all between page requests
+    consistent = True
+    next_start = start
+    try:
+        for _, rows, next_start in iter_pages(call, method, params, start):
+            if encoder is None:
+                if columns is None and format == FORMAT_CSV:
+                    columns = list(rows[0].keys()) if rows else []
+                encoder = _ENCODERS[format](columns)
+                if offset is None:
+                    output.write(encoder.header())
+
+            consistent = False
+            output.write(encoder.encode(rows))
+            consistent = True
+
+            stats.rows += len(rows)
+            stats.pages += 1
+            if on_progress is not None:
+                on_progress(stats)
+            if checkpoint_path is not None and next_start is not None and \
+                    stats.pages % checkpoint_every == 0:
+                checkpoint(next_start)
+    except Exception:
+        # Nothing is written (not even a CSV header) before the first page,
+        # so a failed fresh export starts from scratch and a failed resumed
+        # one keeps its previous checkpoint
+        if consistent and encoder is not None and \
+                checkpoint_path is not None:
+            checkpoint(next_start)
+        output.close()
+        raise
+
+    output.close()
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return stats
@@ -13,6 +13,8 @@ except ImportError:
     from urllib2 import Request, urlopen, HTTPError
     from urllib import urlencode
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 def decode_response(s):
     if sys.version_info.major == 2:
@@ -31,6 +33,26 @@ def request(url, query=None, data=None):
     # Make a request
     request_ = Request(url, data=data,
                        headers={'Content-Type': 'application/json'})
+    return send(request_)
+
+
+def request_stream(url, query=None, body=None, length=None):
+    """Send a JSON request body read from a file-like object by chunks.
+
+    If the body length is unknown the body is sent using chunked transfer
+    encoding (Python 3.6+ only).
+    """
+    if query is not None:
+        url += '?' + urlencode(query)
+
+    headers = {'Content-Type': 'application/json'}
+    if length is not None:
+        headers['Content-Length'] = str(length)
+    request_ = Request(url, data=body, headers=headers)
+    return send(request_)
+
+
+def send(request_):
     try:
         response = urlopen(request_)
     except HTTPError as e:
@@ -45,6 +67,35 @@ def request(url, query=None, data=None):
         raise PyBitrix24Error("Error decoding of server response", e)
 
 
+def download(url, fileobj, query=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Write a response body to a binary file object by chunks.
+
+    :return: int A number of written bytes
+    """
+    if query is not None:
+        url += '?' + urlencode(query)
+
+    try:
+        response = urlopen(Request(url))
+    except Exception as e:
+        raise PBx24RequestError("Error on request", e)
+
+    size = 0
+    try:
+        while True:
+            try:
+                chunk = response.read(chunk_size)
+            except Exception as e:
+                raise PBx24RequestError("Error on reading server response", e)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+            size += len(chunk)
+    finally:
+        response.close()
+    return size
+
+
 def flatten(d):
     """Return a dict as a list of lists.
 
@@ -114,32 +165,132 @@ def encode_url(params):
     return urlencode(url_params, doseq=True)
 
 
+BATCH_MAX_COMMANDS = 50
+BATCH_MAX_BYTES = 256 * 1024
+
+# Size of the batch request body without commands: {"cmd": {}, "halt": false}
+_BATCH_ENVELOPE_BYTES = 32
+
+
+def split_call(name, call):
+    """Return a method name and params of a batch call.
+
+    >>> split_call('a', ('user.get', {'ID': 1}))
+    ('user.get', {'ID': 1})
+    >>> split_call('a', {'method': 'user.get', 'params': {'ID': 1}})
+    ('user.get', {'ID': 1})
+    >>> split_call('a', 'user.current')
+    ('user.current', None)
+    """
+    if isinstance(call, str):
+        return call, None
+    elif isinstance(call, tuple):
+        try:
+            return call[0], call[1]
+        except IndexError as e:
+            raise PyBitrix24Error(
+                'The "' + name + '" call must be a pair of values', e)
+    elif isinstance(call, dict):
+        try:
+            return call['method'], call['params']
+        except KeyError as e:
+            raise PyBitrix24Error(
+                'The "' + name + '" call has the following required '
+                                 'keys: method, params.', e)
+    else:
+        if isinstance(call, list):
+            raise PyBitrix24Error(
+                'The "' + name + '" call must be a tuple')
+        else:
+            raise PyBitrix24Error(
+                'The "' + name + '" call must be a string, a tuple or '
+                                 'a dictionary.')
+
+
+def prepare_command(name, call):
+    method, params = split_call(name, call)
+    if params is None:
+        return method
+    return '{}?{}'.format(method, encode_url(params))
+
+
 def prepare_batch_command(calls):
     commands = {}
     for name, call in calls.items():
-        if isinstance(call, str):
-            command = call
-        elif isinstance(call, tuple):
-            try:
-                command = '{}?{}'.format(call[0], encode_url(call[1]))
-            except IndexError as e:
-                raise PyBitrix24Error(
-                    'The "' + name + '" call must be a pair of values', e)
-        elif isinstance(call, dict):
-            try:
-                command = '{}?{}'.format(call['method'],
-                                         encode_url(call['params']))
-            except KeyError as e:
-                raise PyBitrix24Error(
-                    'The "' + name + '" call has the following required '
-                                     'keys: method, params.', e)
-        else:
-            if isinstance(call, list):
-                raise PyBitrix24Error(
-                    'The "' + name + '" call must be a tuple')
-            else:
-                raise PyBitrix24Error(
-                    'The "' + name + '" call must be a string, a tuple or '
-                                     'a dictionary.')
-        commands[name] = command
+        commands[name] = prepare_command(name, call)
     return commands
+
+
+def measure_command(name, command):
+    """Return a number of bytes a command takes in a batch request body.
+
+    >>> measure_command('a', 'user.get?ID=1')
+    22
+    """
+    return len(json.dumps(name)) + len(json.dumps(command)) + 4
+
+
+def iter_batch_requests(calls, max_commands=BATCH_MAX_COMMANDS,
+                        max_bytes=BATCH_MAX_BYTES):
+    """Split calls into requests limited by both count and encoded size.
+
+    Requests keep the order of calls: batches are yielded as dicts of
+    prepared commands by names, a call which alone doesn't fit the byte
+    budget is yielded as a pair of its name and the call to be sent as
+    a regular request (its params are sent in a request body instead of
+    a query string).
+
+    >>> calls = OrderedDict([('a', 'a.get'), ('b', ('b.add', {'X': 'y' * 9})),
+    ...                      ('c', 'c.get')])
+    >>> list(iter_batch_requests(calls, max_bytes=_BATCH_ENVELOPE_BYTES + 20))
+    [{'a': 'a.get'}, ('b', ('b.add', {'X': 'yyyyyyyyy'})), {'c': 'c.get'}]
+    """
+    budget = max_bytes - _BATCH_ENVELOPE_BYTES
+    batch, batch_size = {}, 0
+    for name, call in calls.items():
+        command = prepare_command(name, call)
+        size = measure_command(name, command)
+        if size > budget:
+            if batch:
+                yield batch
+                batch, batch_size = {}, 0
+            yield name, call
+            continue
+        if len(batch) >= max_commands or batch_size + size > budget:
+            yield batch
+            batch, batch_size = {}, 0
+        batch[name] = command
+        batch_size += size
+    if batch:
+        yield batch
+
+
+def pack_batch_commands(calls, max_commands=BATCH_MAX_COMMANDS,
+                        max_bytes=BATCH_MAX_BYTES):
+    """Split calls into batches limited by both count and encoded size.
+
+    It's the same as :func:`iter_batch_requests` but oversize calls are
+    returned separately.
+
+    >>> calls = OrderedDict([('a', 'a.get'), ('b', 'b.get'), ('c', 'c.get')])
+    >>> pack_batch_commands(calls, max_commands=2)
+    ([{'a': 'a.get', 'b': 'b.get'}, {'c': 'c.get'}], {})
+    >>> pack_batch_commands(calls, max_bytes=_BATCH_ENVELOPE_BYTES + 28)
+    ([{'a': 'a.get', 'b': 'b.get'}, {'c': 'c.get'}], {})
+    >>> pack_batch_commands({'a': ('a.add', {'X': 'y' * 10})}, max_bytes=40)
+    ([], {'a': ('a.add', {'X': 'yyyyyyyyyy'})})
+
+    :param calls: dict Call params by names
+    :param max_commands: int Maximum number of commands per batch
+    :param max_bytes: int Maximum size of a batch request body
+    :return: tuple A list of prepared commands by names for each batch and
+        a dict of oversize calls by names
+    """
+    batches, oversize = [], {}
+    for request_ in iter_batch_requests(calls, max_commands, max_bytes):
+        if isinstance(request_, dict):
+            batches.append(request_)
+        else:
+            name, call = request_
+            oversize[name] = call
+    return batches, oversize
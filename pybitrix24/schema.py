@@ -0,0 +1,172 @@
+import json
+import os
+import re
+import threading
+import time
+
+from .exceptions import PBx24ArgumentError
+from .utils import dump_json_atomically, load_json
+
+SCHEMA_CACHE_FORMAT = 1
+
+_METADATA_METHOD_RE = re.compile(r'^(methods|scope|app\.info|[\w.]+\.fields)$')
+_CRM_METHOD_RE = re.compile(r'^crm\.(\w+)\.(add|update|list)$')
+
+# Operators prefixing field names in filters, e.g. {'>=DATE_CREATE': ...}
+_FILTER_OPERATOR_RE = re.compile(r'^(>=|<=|><|!><|!=|!%|!@|=%|%=|>|<|!|=|%|@)')
+
+
+def is_metadata_method(method):
+    """Return True if a method returns metadata that rarely changes.
+
+    >>> is_metadata_method('crm.deal.fields')
+    True
+    >>> is_metadata_method('crm.deal.list')
+    False
+    """
+    return _METADATA_METHOD_RE.match(method.lower()) is not None
+
+
+class SchemaCache(object):
+    """
+    A disk-persisted cache of metadata responses (methods, scope, app info
+    and field schemas) stored in a JSON file per hostname. A file is loaded
+    lazily on first use and discarded entirely if it was written by another
+    cache format or version, entries older than TTL are requested again.
+    """
+
+    def __init__(self, directory, ttl=24 * 60 * 60, version=None):
+        """
+        :param directory: str A directory for cache files
+        :param ttl: int Lifetime of cache entries in seconds
+        :param version: str An arbitrary version (e.g. of an application)
+            that invalidates the cache when changed
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.version = version
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _path(self, hostname):
+        return os.path.join(self.directory, hostname + '.json')
+
+    @staticmethod
+    def _key(method, params):
+        return json.dumps([method, params], sort_keys=True)
+
+    def _load(self, hostname):
+        entries = self._entries.get(hostname)
+        if entries is not None:
+            return entries
+        entries = {}
+        path = self._path(hostname)
+        if os.path.exists(path):
+            try:
+                data = load_json(path)
+            except ValueError:
+                data = {}  # A corrupted file is rewritten on next set
+            if data.get('format') == SCHEMA_CACHE_FORMAT and \
+                    data.get('version') == self.version:
+                entries = data.get('entries', {})
+        self._entries[hostname] = entries
+        return entries
+
+    def get(self, hostname, method, params=None):
+        """
+        :return: dict Cached response data or None if it's missing or expired
+        """
+        with self._lock:
+            entry = self._load(hostname).get(self._key(method, params))
+        if entry is None or time.time() - entry['stored_at'] > self.ttl:
+            return None
+        # Protect cached data from mutation by a caller
+        return json.loads(json.dumps(entry['data']))
+
+    def set(self, hostname, method, params, data):
+        with self._lock:
+            entries = self._load(hostname)
+            entries[self._key(method, params)] = {
+                'stored_at': time.time(),
+                'data': json.loads(json.dumps(data))
+            }
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            dump_json_atomically(self._path(hostname), {
+                'format': SCHEMA_CACHE_FORMAT,
+                'version': self.version,
+                'entries': entries
+            })
+
+    def invalidate(self, hostname):
+        with self._lock:
+            self._entries.pop(hostname, None)
+            path = self._path(hostname)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _get_key(params, name):
+    """Get a value by a case-insensitive key (e.g. 'fields' or 'FIELDS')."""
+    for key, value in params.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _is_known(name, schema):
+    return name in schema or name == '*' or name.endswith('_*')
+
+
+def validate_params(method, params, get_fields):
+    """
+    Check params of crm.*.add, crm.*.update and crm.*.list methods against
+    a field schema returned by an appropriate crm.*.fields method. Params
+    of other methods aren't checked.
+
+    :raise PBx24ArgumentError: If params contain unknown or read-only fields
+        or miss required ones
+    :param method: str Method name (words separated by dots)
+    :param params: dict Request parameters
+    :param get_fields: callable Returns response data of a fields method
+        by its name
+    """
+    match = _CRM_METHOD_RE.match(method.lower())
+    if match is None or not params:
+        return
+    entity, action = match.groups()
+    schema = get_fields('crm.%s.fields' % entity).get('result')
+    if not isinstance(schema, dict) or \
+            not all(isinstance(f, dict) for f in schema.values()):
+        return
+
+    errors = []
+    if action == 'list':
+        for name in _get_key(params, 'select') or []:
+            if not _is_known(name, schema):
+                errors.append('unknown select field ' + name)
+        for name in _get_key(params, 'filter') or {}:
+            # Skip nested conditions of complex filters
+            if name == 'LOGIC' or str(name).isdigit():
+                continue
+            name = _FILTER_OPERATOR_RE.sub('', name)
+            if not _is_known(name, schema):
+                errors.append('unknown filter field ' + name)
+        for name in _get_key(params, 'order') or {}:
+            if not _is_known(name, schema):
+                errors.append('unknown order field ' + name)
+    else:
+        fields = _get_key(params, 'fields') or {}
+        for name in fields:
+            if name not in schema:
+                errors.append('unknown field ' + name)
+            elif schema[name].get('isReadOnly'):
+                errors.append('read-only field ' + name)
+        if action == 'add':
+            for name, field in sorted(schema.items()):
+                if field.get('isRequired') and name not in fields:
+                    errors.append('missing required field ' + name)
+
+    if errors:
+        raise PBx24ArgumentError(
+            'Invalid params of "%s": %s' % (method, ', '.join(errors)))
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import uuid
+
+from .exceptions import PBx24ArgumentError
+
+# Must be a multiple of 3 to produce base64 chunks without padding
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def _b64encode(view):
+    if sys.version_info.major == 2:
+        return base64.b64encode(view.tobytes())
+    return base64.b64encode(view)
+
+
+def _remaining_size(fileobj):
+    """Return a number of bytes left in a file or None if it's unknown."""
+    raw = getattr(fileobj, 'raw', fileobj)
+    try:
+        position = fileobj.tell()
+        # Wrappers (e.g. GzipFile) expose a descriptor of an underlying file,
+        # so its size is taken only for plain files
+        if isinstance(fileobj, (io.FileIO, io.BufferedReader)) and \
+                isinstance(raw, io.FileIO):
+            size = os.fstat(fileobj.fileno()).st_size
+        else:
+            fileobj.seek(0, os.SEEK_END)
+            size = fileobj.tell()
+            fileobj.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return max(size - position, 0)
+
+
+def _set_path(params, path, value):
+    if isinstance(path, str):
+        path = (path,)
+    if not path:
+        raise PBx24ArgumentError("The 'path' argument must not be empty")
+    params = dict(params or {})
+    node = params
+    for key in path[:-1]:
+        node[key] = dict(node.get(key) or {})
+        node = node[key]
+    node[path[-1]] = value
+    return params
+
+
+class Base64JsonBody(object):
+    """
+    A file-like JSON request body containing a base64-encoded file which is
+    read and encoded chunk by chunk while the body is being sent, so only
+    one chunk of the file is held in memory at a time.
+
+    A file is put to params as a pair of a file name and content (the format
+    of Bitrix24 REST API) by a path of keys, e.g. ``('fileContent',)`` for
+    ``disk.folder.uploadfile`` or ``('fields', 'UF_CRM_FILE', 'fileData')``
+    for CRM file fields.
+    """
+
+    def __init__(self, params, path, fileobj, filename,
+                 chunk_size=BASE64_CHUNK_SIZE):
+        """
+        :raise PBx24ArgumentError: If the chunk size isn't a multiple of 3
+        :param params: dict Request parameters
+        :param path: tuple Keys of params to put the file to
+        :param fileobj: file A binary file object
+        :param filename: str A file name
+        :param chunk_size: int Size of file chunks (a multiple of 3)
+        """
+        if chunk_size <= 0 or chunk_size % 3 != 0:
+            raise PBx24ArgumentError(
+                "The 'chunk_size' argument must be a positive multiple of 3")
+        placeholder = 'pybitrix24-file-' + uuid.uuid4().hex
+        body = json.dumps(_set_path(params, path, [filename, placeholder]))
+        prefix, suffix = body.split(placeholder)
+        self._prefix = prefix.encode('utf-8')
+        self._suffix = suffix.encode('utf-8')
+        self._fileobj = fileobj
+        self._chunk = bytearray(chunk_size)
+        self._pieces = self._iter_pieces()
+        self._piece = b''
+        self._offset = 0
+
+        size = _remaining_size(fileobj)
+        self.length = None if size is None else \
+            len(self._prefix) + (size + 2) // 3 * 4 + len(self._suffix)
+
+    def _readinto_full(self):
+        """Fill the chunk up unless the end of file is reached."""
+        view = memoryview(self._chunk)
+        filled = 0
+        while filled < len(view):
+            n = self._fileobj.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        return view[:filled]
+
+    def _iter_pieces(self):
+        yield self._prefix
+        while True:
+            view = self._readinto_full()
+            if not len(view):
+                break
+            yield _b64encode(view)
+        yield self._suffix
+
+    def _fill_piece(self):
+        """Move to the next piece if the current one is read up."""
+        while self._offset >= len(self._piece):
+            try:
+                self._piece, self._offset = next(self._pieces), 0
+            except StopIteration:
+                return False
+        return True
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the body. If size is not set, the rest of
+        the current chunk is read instead of the whole body to keep memory
+        usage flat, an empty result means the end of the body.
+        """
+        if size is None or size < 0:
+            if not self._fill_piece():
+                return b''
+            data = self._piece[self._offset:]
+            self._offset = len(self._piece)
+            return data
+
+        parts = []
+        while size != 0 and self._fill_piece():
+            end = min(len(self._piece), self._offset + size)
+            size -= end - self._offset
+            parts.append(self._piece[self._offset:end])
+            self._offset = end
+        return b''.join(parts)
+
+
+class HashingFile(object):
+    """A file-like wrapper calculating SHA-256 of data read through it."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self.length = getattr(fileobj, 'length', None)
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._fileobj.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
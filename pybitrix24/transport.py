@@ -0,0 +1,241 @@
+import io
+import json
+import os
+import re
+import threading
+import uuid
+
+from collections import defaultdict, deque
+
+from .exceptions import PBx24ArgumentError, PBx24RequestError
+from .requester import download, request, request_stream, \
+    DOWNLOAD_CHUNK_SIZE
+from .streams import HashingFile
+from .utils import replace_file
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+
+REDACTED = '[redacted]'
+
+# A webhook code is a secret part of a webhook URL: /rest/<user_id>/<code>/
+_WEBHOOK_CODE_RE = re.compile(r'(/rest/\d+/)[^/]+/')
+
+
+class Transport(object):
+    """
+    An interface of the I/O layer used by :class:`Bitrix24` to send requests.
+    Subclass it to plug in a pooled, asynchronous or fake implementation.
+    """
+
+    def request(self, url, query=None, data=None):
+        """
+        Send a request and decode a JSON response.
+
+        :raise PBx24RequestError: If a request can't be sent
+        :param url: str An absolute URL
+        :param query: dict Query parameters
+        :param data: dict Request body (encoded as JSON)
+        :return: dict Response data
+        """
+        raise NotImplementedError
+
+    def request_stream(self, url, query=None, body=None):
+        """
+        Send a JSON request body read from a file-like object by chunks and
+        decode a JSON response. The body length is taken from its ``length``
+        attribute if set.
+
+        :raise PBx24RequestError: If a request can't be sent
+        :param url: str An absolute URL
+        :param query: dict Query parameters
+        :param body: file A file-like request body
+        :return: dict Response data
+        """
+        raise NotImplementedError
+
+    def download(self, url, fileobj, query=None):
+        """
+        Write a response body to a binary file object by chunks.
+
+        :raise PBx24RequestError: If a request can't be sent
+        :param url: str An absolute URL
+        :param fileobj: file A binary file object
+        :param query: dict Query parameters
+        :return: int A number of written bytes
+        """
+        raise NotImplementedError
+
+
+class UrllibTransport(Transport):
+    """The default transport built on top of the standard urllib."""
+
+    def request(self, url, query=None, data=None):
+        return request(url, query, data)
+
+    def request_stream(self, url, query=None, body=None):
+        return request_stream(url, query, body,
+                              getattr(body, 'length', None))
+
+    def download(self, url, fileobj, query=None):
+        return download(url, fileobj, query)
+
+
+class RecordReplayTransport(Transport):
+    """
+    A transport that records request/response pairs of a real transport to
+    a file (one JSON object per line) and replays them later without network
+    access. Replayed responses are matched by URL, query and data, and
+    returned in the order they were recorded. Streamed request bodies are
+    matched by their digest, downloaded files are stored in a directory
+    next to the recordings file.
+
+    Secrets are redacted before recording and matching, so recordings stay
+    valid after tokens are refreshed. Query parameters listed in
+    ``ignore_query`` are dropped, both from the query and from the URL
+    itself. Webhook codes in URLs and response fields listed in
+    ``redact_response`` (tokens by default) are replaced with
+    :data:`REDACTED`. Other data (e.g. CRM records) is stored as is.
+
+    Usage::
+
+        bx24 = Bitrix24('my-subdomain.bitrix24.com',
+                        transport=RecordReplayTransport('calls.ndjson',
+                                                        mode='record'))
+    """
+    MODE_RECORD = 'record'
+    MODE_REPLAY = 'replay'
+
+    def __init__(self, path, mode=MODE_REPLAY, transport=None, loop=False,
+                 ignore_query=('auth', 'client_secret', 'refresh_token',
+                               'code'),
+                 redact_response=('access_token', 'refresh_token')):
+        """
+        :raise PBx24ArgumentError: If mode is not supported
+        :param path: str A path of the recordings file
+        :param mode: str 'record' or 'replay'
+        :param transport: Transport A real transport used for recording
+            (:class:`UrllibTransport` by default)
+        :param loop: bool Replay responses of the same request over and over
+            again instead of failing when they're exhausted
+        :param ignore_query: tuple Names of query parameters to ignore
+        :param redact_response: tuple Names of response fields to redact
+        """
+        if mode not in (self.MODE_RECORD, self.MODE_REPLAY):
+            raise PBx24ArgumentError(
+                "The 'mode' argument must be 'record' or 'replay'")
+        self.path = path
+        self.mode = mode
+        self.transport = transport if transport is not None \
+            else UrllibTransport()
+        self.loop = loop
+        self.ignore_query = frozenset(ignore_query)
+        self.redact_response = frozenset(redact_response)
+        self._lock = threading.Lock()
+        self._recordings = None
+
+    def _redact_url(self, url):
+        parts = urlsplit(_WEBHOOK_CODE_RE.sub(r'\1' + REDACTED + '/', url))
+        # Query parameters may be a part of a URL (e.g. DOWNLOAD_URL)
+        query = [(k, v) for k, v in parse_qsl(parts.query, True)
+                 if k not in self.ignore_query]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def _normalize(self, url, query, data):
+        url = self._redact_url(url)
+        if query is not None:
+            query = dict((k, v) for k, v in query.items()
+                         if k not in self.ignore_query)
+        # Round trip through JSON to match loaded recordings
+        return json.loads(json.dumps({'url': url, 'query': query,
+                                      'data': data}))
+
+    @staticmethod
+    def _key(entry):
+        return json.dumps([entry['url'], entry['query'], entry['data']],
+                          sort_keys=True)
+
+    def request(self, url, query=None, data=None):
+        if self.mode == self.MODE_RECORD:
+            response = self.transport.request(url, query, data)
+            self._record(url, query, data, response)
+            return response
+        return self._replay(url, query, data)
+
+    def request_stream(self, url, query=None, body=None):
+        # A streamed body is matched by its digest instead of content
+        reader = HashingFile(body)
+        if self.mode == self.MODE_RECORD:
+            response = self.transport.request_stream(url, query, reader)
+            self._record(url, query, {'sha256': reader.hexdigest()},
+                         response)
+            return response
+        while reader.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+        return self._replay(url, query, {'sha256': reader.hexdigest()})
+
+    def download(self, url, fileobj, query=None):
+        # Downloaded content is stored next to recordings by its digest
+        files_path = self.path + '.files'
+        if self.mode == self.MODE_RECORD:
+            if not os.path.isdir(files_path):
+                os.makedirs(files_path)
+            tmp_path = os.path.join(files_path, uuid.uuid4().hex + '.tmp')
+            with io.open(tmp_path, 'wb') as f:
+                writer = HashingFile(f)
+                self.transport.download(url, writer, query)
+            digest = writer.hexdigest()
+            replace_file(tmp_path, os.path.join(files_path, digest))
+            self._record(url, query, {'download': True}, {'sha256': digest})
+        else:
+            digest = self._replay(url, query, {'download': True})['sha256']
+        with io.open(os.path.join(files_path, digest), 'rb') as f:
+            size = 0
+            while True:
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fileobj.write(chunk)
+                size += len(chunk)
+        return size
+
+    def _record(self, url, query, data, response):
+        entry = self._normalize(url, query, data)
+        if isinstance(response, dict):
+            response = dict((k, REDACTED if k in self.redact_response else v)
+                            for k, v in response.items())
+        entry['response'] = response
+        line = json.dumps(entry, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line if isinstance(line, type(u'')) else
+                        line.decode('utf-8'))
+                f.write(u'\n')
+
+    def _load(self):
+        recordings = defaultdict(deque)
+        with io.open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                recordings[self._key(entry)].append(entry['response'])
+        return recordings
+
+    def _replay(self, url, query, data):
+        key = self._key(self._normalize(url, query, data))
+        with self._lock:
+            if self._recordings is None:
+                self._recordings = self._load()
+            responses = self._recordings.get(key)
+            if not responses:
+                raise PBx24RequestError(
+                    "No recorded response for the request", url)
+            response = responses.popleft()
+            if self.loop:
+                responses.append(response)
+        # Protect recordings from mutation by a caller
+        return json.loads(json.dumps(response))
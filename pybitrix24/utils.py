@@ -0,0 +1,64 @@
+import errno
+import io
+import json
+import os
+import tempfile
+
+
+def to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def replace_file(src, dst):
+    """Rename a file overwriting the destination.
+
+    It's atomic everywhere except Python 2 on Windows, where the destination
+    is removed first, so readers may briefly find no file.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    elif os.name != 'nt':
+        os.rename(src, dst)  # Overwrites atomically on POSIX
+    else:
+        while True:
+            try:
+                os.rename(src, dst)
+                return
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Another writer may remove or replace the destination meanwhile
+            try:
+                os.remove(dst)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def load_json(path):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dump_json_atomically(path, data):
+    """Write data as JSON through a unique temporary file.
+
+    Readers see either the previous or the new complete file and several
+    processes may write the same file concurrently, the last write wins
+    (see :func:`replace_file` for the only exception).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with io.open(fd, 'wb') as f:
+            f.write(to_bytes(json.dumps(data, sort_keys=True)))
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
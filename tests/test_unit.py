@@ -1,7 +1,28 @@
+# -*- coding: utf-8 -*-
+import base64
+import gzip
+import io
+import json
+import os
 import re
+import shutil
+import tempfile
+import threading
 import unittest
 
-from pybitrix24 import Bitrix24, PBx24AttributeError, get_error_if_present
+from collections import OrderedDict
+
+from pybitrix24 import Base64JsonBody, Bitrix24, DuplicateCache, \
+    PBx24ArgumentError, PBx24AttributeError, PBx24RequestError, \
+    RecordReplayTransport, SchemaCache, Transport, UrllibTransport, \
+    export_list, find_duplicates, get_error_if_present
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qsl
 
 
 def is_url(s):
@@ -43,3 +64,586 @@ class Bitrix24UnitTests(unittest.TestCase):
         for td in test_data:
             error = get_error_if_present(td['data'])
             self.assertEqual(error, td['error'])
+
+
+class UnitTestCase(unittest.TestCase):
+    """A base test case providing a hostname and a temporary directory."""
+    hostname = 'test.bitrix24.com'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+
+class FakeListCaller(object):
+    """Serve pages of a list method like Bitrix24 REST API does."""
+
+    def __init__(self, rows, page_size=2, fail_at=None):
+        self.rows = rows
+        self.page_size = page_size
+        self.fail_at = fail_at
+        self.starts = []
+
+    def __call__(self, method, params):
+        start = params['start']
+        self.starts.append(start)
+        if start == self.fail_at:
+            return {'error': 'QUERY_LIMIT_EXCEEDED'}
+        data = {'result': self.rows[start:start + self.page_size],
+                'total': len(self.rows)}
+        if start + self.page_size < len(self.rows):
+            data['next'] = start + self.page_size
+        return data
+
+
+class ExportUnitTests(UnitTestCase):
+    rows = [{'ID': str(i), 'TITLE': u'Deal №%d' % i} for i in range(7)]
+
+    def setUp(self):
+        super(ExportUnitTests, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'out')
+        self.checkpoint_path = os.path.join(self.tmp_dir, 'checkpoint')
+
+    def read_ndjson(self, compress=False):
+        opener = gzip.open if compress else io.open
+        with opener(self.path, 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def test_export_list__ndjson(self):
+        progress = []
+        stats = export_list(FakeListCaller(self.rows), 'crm.deal.list',
+                            self.path, on_progress=progress.append)
+        self.assertEqual(self.read_ndjson(), self.rows)
+        self.assertEqual(stats.rows, 7)
+        self.assertEqual(stats.pages, 4)
+        self.assertEqual(len(progress), 4)
+        self.assertGreaterEqual(stats.rows_per_second, 0)
+
+    def test_export_list__csv_gzip(self):
+        export_list(FakeListCaller(self.rows), 'crm.deal.list', self.path,
+                    format='csv', compress=True, columns=['TITLE', 'ID'])
+        with gzip.open(self.path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'TITLE,ID')
+        self.assertEqual(lines[1], u'Deal №0,0')
+        self.assertEqual(len(lines), 8)
+
+    def test_export_list__resume(self):
+        for compress in (False, True):
+            caller = FakeListCaller(self.rows, fail_at=4)
+            self.assertRaises(PBx24RequestError, export_list, caller,
+                              'crm.deal.list', self.path, compress=compress,
+                              checkpoint_path=self.checkpoint_path,
+                              checkpoint_every=1)
+            self.assertTrue(os.path.exists(self.checkpoint_path))
+
+            caller = FakeListCaller(self.rows)
+            stats = export_list(caller, 'crm.deal.list', self.path,
+                                compress=compress,
+                                checkpoint_path=self.checkpoint_path)
+            self.assertEqual(caller.starts, [4, 6])
+            self.assertEqual(stats.rows, 7)
+            self.assertEqual(self.read_ndjson(compress), self.rows)
+            self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_export_list__resume_after_first_page(self):
+        caller = FakeListCaller(self.rows, fail_at=0)
+        self.assertRaises(PBx24RequestError, export_list, caller,
+                          'crm.deal.list', self.path, format='csv',
+                          checkpoint_path=self.checkpoint_path)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+        export_list(FakeListCaller(self.rows), 'crm.deal.list', self.path,
+                    format='csv', checkpoint_path=self.checkpoint_path)
+        with io.open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'ID,TITLE')
+        self.assertEqual(len(lines), 8)
+
+    def test_export_list__checkpoint_mismatch(self):
+        caller = FakeListCaller(self.rows, fail_at=2)
+        self.assertRaises(PBx24RequestError, export_list, caller,
+                          'crm.deal.list', self.path,
+                          checkpoint_path=self.checkpoint_path)
+        self.assertRaises(PBx24ArgumentError, export_list, caller,
+                          'crm.lead.list', self.path,
+                          checkpoint_path=self.checkpoint_path)
+
+
+class EchoTransport(Transport):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, url, query=None, data=None):
+        self.requests.append((url, query, data))
+        return {'result': {'url': url, 'data': data}}
+
+
+class TokensTransport(Transport):
+    def request(self, url, query=None, data=None):
+        if '/oauth/token/' in url:
+            return {'access_token': 'access-token',
+                    'refresh_token': 'refresh-token'}
+        return {'result': data}
+
+
+class TransportUnitTests(UnitTestCase):
+    def setUp(self):
+        super(TransportUnitTests, self).setUp()
+        self.path = os.path.join(self.tmp_dir, 'recordings.ndjson')
+
+    def test_call__uses_transport(self):
+        transport = EchoTransport()
+        bx24 = Bitrix24(self.hostname, transport=transport)
+        bx24._access_token = 'token'
+        data = bx24.call('user.get', {'ID': 1})
+        self.assertEqual(data['result']['data'], {'ID': 1})
+        self.assertEqual(transport.requests, [
+            ('https://test.bitrix24.com/rest/user.get.json',
+             {'auth': 'token'}, {'ID': 1})])
+
+    def test_record_replay(self):
+        inner = EchoTransport()
+        bx24 = Bitrix24(self.hostname, transport=RecordReplayTransport(
+            self.path, mode='record', transport=inner))
+        bx24._access_token = 'old-token'
+        recorded = bx24.call('user.get', {'ID': 1})
+        with io.open(self.path, encoding='utf-8') as f:
+            self.assertNotIn('old-token', f.read())
+
+        bx24.transport = RecordReplayTransport(self.path)
+        bx24._access_token = 'new-token'
+        self.assertEqual(bx24.call('user.get', {'ID': 1}), recorded)
+        self.assertEqual(len(inner.requests), 1)
+        # Recorded responses are exhausted
+        self.assertRaises(PBx24RequestError, bx24.call, 'user.get', {'ID': 1})
+        self.assertRaises(PBx24RequestError, bx24.call, 'user.get', {'ID': 2})
+
+        bx24.transport = RecordReplayTransport(self.path, loop=True)
+        for _ in range(3):
+            self.assertEqual(bx24.call('user.get', {'ID': 1}), recorded)
+
+    def test_record_replay__secrets(self):
+        inner = TokensTransport()
+        bx24 = Bitrix24(self.hostname, client_id='id', client_secret='secret',
+                        transport=RecordReplayTransport(
+                            self.path, mode='record', transport=inner))
+        tokens = bx24.obtain_tokens('auth-code')
+        self.assertEqual(tokens['access_token'], 'access-token')
+        recorded = bx24.call_webhook('webhook-code', 'user.get', {'ID': 1})
+        with io.open(self.path, encoding='utf-8') as f:
+            content = f.read()
+        for secret in ('secret', 'auth-code', 'access-token', 'refresh-token',
+                       'webhook-code'):
+            self.assertNotIn(secret, content)
+
+        bx24.transport = RecordReplayTransport(self.path)
+        self.assertEqual(bx24.obtain_tokens('another-code')['access_token'],
+                         '[redacted]')
+        self.assertEqual(bx24.call_webhook('another-code', 'user.get',
+                                           {'ID': 1}), recorded)
+
+
+class BatchTransport(Transport):
+    """Execute batch commands like Bitrix24 REST API does."""
+
+    def __init__(self, fail_at=None):
+        self.requests = []
+        self.fail_at = fail_at
+
+    def request(self, url, query=None, data=None):
+        self.requests.append((url, data))
+        if len(self.requests) == self.fail_at:
+            return {'error': 'QUERY_LIMIT_EXCEEDED'}
+        if url.endswith('/batch.json'):
+            result = dict((name, command) for name, command
+                          in data['cmd'].items() if 'fail' not in command)
+            errors = dict((name, 'Error') for name, command
+                          in data['cmd'].items() if 'fail' in command)
+            return {'result': {'result': result, 'result_error': errors or [],
+                               'result_total': [], 'result_next': [],
+                               'result_time': {}}}
+        return {'result': data, 'time': {}}
+
+
+class BatchPackingUnitTests(UnitTestCase):
+    def setUp(self):
+        super(BatchPackingUnitTests, self).setUp()
+        self.transport = BatchTransport()
+        self.bx24 = Bitrix24(self.hostname, transport=self.transport)
+
+    def test_call_batches__count(self):
+        calls = dict(('get_%d' % i, ('user.get', {'ID': i}))
+                     for i in range(120))
+        data = self.bx24.call_batches(calls)
+        self.assertEqual(len(self.transport.requests), 3)
+        self.assertEqual(len(data['result']['result']), 120)
+        self.assertEqual(data['result']['result_error'], [])
+
+    def test_call_batches__size(self):
+        fields = {'FIELDS': {'COMMENTS': 'x' * 1000}}
+        calls = OrderedDict(('add_%d' % i, ('crm.deal.add', fields))
+                            for i in range(10))
+        calls['huge'] = ('crm.deal.add', {'FIELDS': {'COMMENTS': 'x' * 5000}})
+        data = self.bx24.call_batches_webhook('code', calls, max_bytes=4000)
+        batches = [cmd for url, cmd in self.transport.requests
+                   if url.endswith('/batch.json')]
+        self.assertEqual([len(b['cmd']) for b in batches], [3, 3, 3, 1])
+        for batch in batches:
+            self.assertLessEqual(len(json.dumps(batch)), 4000)
+        # The oversize call is sent as a regular request
+        self.assertEqual(self.transport.requests[-1],
+                         ('https://test.bitrix24.com/rest/1/code/'
+                          'crm.deal.add.json', calls['huge'][1]))
+        self.assertEqual(len(data['result']['result']), 11)
+
+    def test_call_batches__request_error(self):
+        self.transport.fail_at = 2
+        calls = OrderedDict(('add_%d' % i, ('crm.deal.add', {'ID': i}))
+                            for i in range(3))
+        data = self.bx24.call_batches(calls, max_commands=1)
+        self.assertEqual(len(self.transport.requests), 2)
+        self.assertEqual(data['error'], 'QUERY_LIMIT_EXCEEDED')
+        self.assertEqual(list(data['result']['result']), ['add_0'])
+        self.assertEqual(data['result']['result_error'], {'add_1': {
+            'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': None}})
+
+    def test_call_batches__order(self):
+        calls = OrderedDict([
+            ('a', 'user.get'),
+            ('huge', ('crm.deal.add', {'FIELDS': {'COMMENTS': 'x' * 5000}})),
+            ('b', 'user.get')])
+        self.bx24.call_batches(calls, max_bytes=4000)
+        self.assertEqual([url.rsplit('/', 1)[1]
+                          for url, _ in self.transport.requests],
+                         ['batch.json', 'crm.deal.add.json', 'batch.json'])
+
+    def test_call_batches__halt_on_error(self):
+        calls = {'a': 'fail.get', 'b': 'user.get'}
+        data = self.bx24.call_batches(calls, halt_on_error=True,
+                                      max_commands=1)
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual(data['result']['result_error'], {'a': 'Error'})
+
+
+class SchemaTransport(Transport):
+    fields = {
+        'ID': {'type': 'integer', 'isRequired': False, 'isReadOnly': True},
+        'TITLE': {'type': 'string', 'isRequired': True, 'isReadOnly': False},
+        'STAGE_ID': {'type': 'crm_status', 'isRequired': False,
+                     'isReadOnly': False},
+    }
+
+    def __init__(self):
+        self.urls = []
+
+    def request(self, url, query=None, data=None):
+        self.urls.append(url)
+        if url.endswith('/crm.deal.fields.json'):
+            return {'result': json.loads(json.dumps(self.fields))}
+        return {'error': 'ERROR_METHOD_NOT_FOUND'}
+
+
+class SchemaCacheUnitTests(UnitTestCase):
+    def setUp(self):
+        super(SchemaCacheUnitTests, self).setUp()
+        self.transport = SchemaTransport()
+
+    def create_bx24(self, **kwargs):
+        return Bitrix24(self.hostname, transport=self.transport,
+                        schema_cache=SchemaCache(self.tmp_dir, **kwargs))
+
+    def test_call_schema__warm_start(self):
+        data = self.create_bx24().call_schema('crm.deal.fields')
+        self.assertEqual(data['result'], SchemaTransport.fields)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmp_dir, self.hostname + '.json')))
+
+        # A new process reads the schema from disk
+        bx24 = self.create_bx24()
+        self.assertEqual(bx24.call_schema('crm.deal.fields'), data)
+        self.assertEqual(len(self.transport.urls), 1)
+
+        # Expired entries and other versions are requested again
+        self.create_bx24(ttl=-1).call_schema('crm.deal.fields')
+        self.create_bx24(version='2').call_schema('crm.deal.fields')
+        self.assertEqual(len(self.transport.urls), 3)
+
+    def test_call_schema__copies(self):
+        bx24 = self.create_bx24()
+        bx24.call_schema('crm.deal.fields')['result'].clear()
+        self.assertEqual(bx24.call_schema('crm.deal.fields')['result'],
+                         SchemaTransport.fields)
+
+    def test_schema_cache__concurrent_writes(self):
+        caches = [SchemaCache(self.tmp_dir) for _ in range(4)]
+        errors = []
+
+        def write(cache):
+            try:
+                for i in range(50):
+                    cache.set(self.hostname, 'scope', None, {'result': [i]})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(cache,))
+                   for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.tmp_dir), [self.hostname + '.json'])
+        self.assertEqual(SchemaCache(self.tmp_dir).get(self.hostname, 'scope'),
+                         {'result': [49]})
+
+    def test_call_schema__errors_are_not_cached(self):
+        bx24 = self.create_bx24()
+        bx24.call_schema('scope')
+        bx24.call_schema('scope')
+        self.assertEqual(len(self.transport.urls), 2)
+        self.assertRaises(PBx24ArgumentError, bx24.call_schema,
+                          'crm.deal.list')
+
+    def test_validate_params(self):
+        bx24 = self.create_bx24()
+        bx24.validate_params('crm.deal.add', {'fields': {'TITLE': 'Deal'}})
+        bx24.validate_params('crm.deal.list', {
+            'select': ['*', 'UF_*'], 'order': {'ID': 'ASC'},
+            'filter': {'>=ID': 1, '!STAGE_ID': 'WON'}})
+        bx24.validate_params('user.get', {'UNKNOWN': 1})
+        invalid = [
+            ('crm.deal.add', {'fields': {'STAGE_ID': 'NEW'}}),
+            ('crm.deal.update', {'id': 1, 'fields': {'ID': 2}}),
+            ('crm.deal.update', {'id': 1, 'FIELDS': {'TITEL': 'Deal'}}),
+            ('crm.deal.list', {'filter': {'>TITEL': 'Deal'}}),
+        ]
+        for method, params in invalid:
+            self.assertRaises(PBx24ArgumentError, bx24.validate_params,
+                              method, params)
+        self.assertEqual(len(self.transport.urls), 1)
+
+
+class StreamTransport(Transport):
+    def __init__(self):
+        self.requests = []
+
+    def request_stream(self, url, query=None, body=None):
+        content = body.read(7) + b''.join(iter(body.read, b''))
+        self.requests.append((url, query, body.length, content))
+        return {'result': json.loads(content.decode('utf-8'))}
+
+    def download(self, url, fileobj, query=None):
+        fileobj.write(b'content of ' + url.encode('utf-8'))
+        return 11 + len(url)
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'x' * 100000)
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamsUnitTests(UnitTestCase):
+    content = bytes(bytearray(range(256))) * 100
+
+    def test_base64_json_body(self):
+        params = {'id': 1, 'fields': {'TITLE': u'Файл'}}
+        path = ('fields', 'UF_CRM_FILE', 'fileData')
+        for size in (0, 1, 2, 3, 100, len(self.content)):
+            fileobj = io.BytesIO(self.content[:size])
+            body = Base64JsonBody(params, path, fileobj, 'a.bin',
+                                  chunk_size=48)
+            chunks = iter(lambda: body.read(5), b'')
+            data = b''.join(chunks)
+            self.assertEqual(len(data), body.length)
+            self.assertEqual(json.loads(data.decode('utf-8')), {
+                'id': 1, 'fields': {'TITLE': u'Файл', 'UF_CRM_FILE': {
+                    'fileData': ['a.bin', base64.b64encode(
+                        self.content[:size]).decode('ascii')]}}})
+        self.assertRaises(PBx24ArgumentError, Base64JsonBody, {}, 'a',
+                          io.BytesIO(), 'a.bin', chunk_size=10)
+
+    def test_base64_json_body__wrapped_file(self):
+        path = os.path.join(self.tmp_dir, 'a.bin.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(self.content)
+        with gzip.open(path, 'rb') as f:
+            body = Base64JsonBody({}, 'fileContent', f, 'a.bin')
+            content = b''.join(iter(body.read, b''))
+            # A size of the compressed file must not be used. Python 2 can't
+            # seek to the end of GzipFile, so the body is sent chunked there
+            if body.length is not None:
+                self.assertEqual(body.length, len(content))
+            data = json.loads(content.decode('utf-8'))
+        self.assertEqual(base64.b64decode(data['fileContent'][1]),
+                         self.content)
+
+        path = os.path.join(self.tmp_dir, 'a.bin')
+        with io.open(path, 'wb') as f:
+            f.write(self.content)
+        with io.open(path, 'rb') as f:
+            f.seek(100)
+            body = Base64JsonBody({}, 'fileContent', f, 'a.bin')
+            self.assertEqual(body.length, len(b''.join(iter(body.read, b''))))
+
+    def test_base64_json_body__unbounded_read(self):
+        body = Base64JsonBody({}, 'fileContent', io.BytesIO(self.content),
+                              'a.bin', chunk_size=48)
+        chunks = list(iter(body.read, b''))
+        self.assertLessEqual(max(len(c) for c in chunks), 64)
+        data = json.loads(b''.join(chunks).decode('utf-8'))
+        self.assertEqual(base64.b64decode(data['fileContent'][1]),
+                         self.content)
+
+    def test_call_upload(self):
+        transport = StreamTransport()
+        bx24 = Bitrix24(self.hostname, transport=transport)
+        path = os.path.join(self.tmp_dir, 'a.bin')
+        with io.open(path, 'wb') as f:
+            f.write(self.content)
+        with io.open(path, 'rb') as f:
+            data = bx24.call_upload('disk.folder.uploadfile', {'id': 1}, f,
+                                    code='code')
+        self.assertEqual(data['result']['fileContent'], [
+            'a.bin', base64.b64encode(self.content).decode('ascii')])
+        url, query, length, content = transport.requests[0]
+        self.assertEqual(url, 'https://test.bitrix24.com/rest/1/code/'
+                              'disk.folder.uploadfile.json')
+        self.assertEqual(length, len(content))
+
+    def test_record_replay__streams(self):
+        recordings_path = os.path.join(self.tmp_dir, 'recordings.ndjson')
+        inner = StreamTransport()
+        bx24 = Bitrix24(self.hostname, transport=RecordReplayTransport(
+            recordings_path, mode='record', transport=inner))
+        for mode in ('record', 'replay'):
+            bx24.transport.mode = mode
+            data = bx24.call_upload('disk.folder.uploadfile', {'id': 1},
+                                    io.BytesIO(self.content), filename='a.bin')
+            self.assertEqual(data['result']['id'], 1)
+            fileobj = io.BytesIO()
+            size = bx24.download_file(
+                'https://example.com/a?auth=token-%s&id=1' % mode, fileobj)
+            self.assertEqual(fileobj.getvalue(),
+                             b'content of https://example.com/a?auth=token-'
+                             b'record&id=1')
+            self.assertEqual(size, len(fileobj.getvalue()))
+        self.assertEqual(len(inner.requests), 1)
+        with io.open(recordings_path, encoding='utf-8') as f:
+            self.assertNotIn('token-record', f.read())
+        self.assertRaises(PBx24RequestError, bx24.call_upload,
+                          'disk.folder.uploadfile', {'id': 2},
+                          io.BytesIO(self.content), filename='a.bin')
+
+    def test_urllib_transport__streams(self):
+        server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_address[1]
+            body = Base64JsonBody({}, 'fileContent',
+                                  io.BytesIO(self.content), filename='a.bin')
+            data = UrllibTransport().request_stream(url, body=body)
+            self.assertEqual(base64.b64decode(data['fileContent'][1]),
+                             self.content)
+
+            fileobj = io.BytesIO()
+            self.assertEqual(UrllibTransport().download(url, fileobj), 100000)
+            self.assertEqual(fileobj.getvalue(), b'x' * 100000)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class DuplicatesTransport(Transport):
+    """Find duplicates among known contacts like Bitrix24 REST API does."""
+    contacts = {'+15550109988': [1, 2], 'john@example.com': [3]}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = []
+
+    def request(self, url, query=None, data=None):
+        result = {}
+        for name, command in data['cmd'].items():
+            with self.lock:
+                self.commands.append(command)
+            values = [v for k, v in parse_qsl(command.split('?', 1)[1])
+                      if k == 'values[]']
+            ids = sorted(set(i for v in values
+                             for i in self.contacts.get(v, [])))
+            result[name] = {'CONTACT': ids} if ids else []
+        return {'result': {'result': result, 'result_error': []}}
+
+
+class DuplicatesUnitTests(UnitTestCase):
+    def setUp(self):
+        super(DuplicatesUnitTests, self).setUp()
+        self.transport = DuplicatesTransport()
+        self.bx24 = Bitrix24(self.hostname, transport=self.transport)
+
+    def test_find_duplicates(self):
+        values = ['+1 (555) 010-99-88', '+15550109988', 'n/a'] + \
+            ['+1 555 000 %04d' % i for i in range(1199)]
+        data = find_duplicates(self.bx24.call, 'PHONE', values)
+        self.assertEqual(data['+1 (555) 010-99-88'], {'CONTACT': [1, 2]})
+        self.assertEqual(data['+15550109988'], {'CONTACT': [1, 2]})
+        self.assertEqual(data['n/a'], {})
+        self.assertEqual(data['+1 555 000 0001'], {})
+        self.assertEqual(len(data), len(values))
+        # 60 group calls and 20 single value calls of the matched group
+        self.assertEqual(len(self.transport.commands), 60 + 20)
+
+    def test_find_duplicates__cache(self):
+        cache = DuplicateCache()
+        values = ['John@Example.com', 'jane@example.com']
+        data = find_duplicates(self.bx24.call, 'EMAIL', values, cache=cache)
+        self.assertEqual(data, {'John@Example.com': {'CONTACT': [3]},
+                                'jane@example.com': {}})
+        commands = len(self.transport.commands)
+        self.assertEqual(find_duplicates(self.bx24.call, 'EMAIL',
+                                         [' john@example.com'], cache=cache),
+                         {' john@example.com': {'CONTACT': [3]}})
+        self.assertEqual(len(self.transport.commands), commands)
+        self.assertRaises(PBx24ArgumentError, find_duplicates,
+                          self.bx24.call, 'FAX', values)
+
+    def test_duplicate_cache__pruning(self):
+        cache = DuplicateCache(max_size=3)
+        for i in range(5):
+            cache.set(i, {'CONTACT': [i]})
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(4), {'CONTACT': [4]})
+
+        cache = DuplicateCache(ttl=-1)
+        for i in range(5):
+            cache.set(i, {})
+        self.assertEqual(len(cache), 0)
+
+    def test_find_duplicates__copies(self):
+        cache = DuplicateCache()
+        values = [15550109988, '+1 555 010 99 88', None]
+        data = find_duplicates(self.bx24.call, 'PHONE', values, cache=cache)
+        self.assertEqual(data[15550109988], {})
+        self.assertEqual(data[None], {})
+        data['+1 555 010 99 88']['CONTACT'].append(5)
+        data = find_duplicates(self.bx24.call, 'PHONE',
+                               ['+15550109988', '+1 (555) 010-99-88'],
+                               cache=cache)
+        self.assertEqual(data['+15550109988'], {'CONTACT': [1, 2]})
+        data['+15550109988']['CONTACT'].append(5)
+        self.assertEqual(data['+1 (555) 010-99-88'], {'CONTACT': [1, 2]})